@@ -20,8 +20,9 @@ from bonito.data import ChunkDataSet
 def align(samples, pointers, reference):
     """ align to the start of the mapping """
     squiggle_duration = len(samples)
-    mapped_off_the_start = len(pointers[pointers < 0])
-    mapped_off_the_end = len(pointers[pointers >= squiggle_duration])
+    # pointers are monotone so the out of range counts are two binary searches
+    mapped_off_the_start = np.searchsorted(pointers, 0, side='left')
+    mapped_off_the_end = len(pointers) - np.searchsorted(pointers, squiggle_duration, side='left')
     pointers = pointers[mapped_off_the_start:len(pointers) - mapped_off_the_end]
     reference = reference[mapped_off_the_start:len(reference) - mapped_off_the_end]
     return samples[pointers[0]:pointers[-1]], pointers - pointers[0], reference
@@ -38,10 +39,10 @@ def scale(read, normalise=True):
 
 
 def pad_lengths(ragged_array, max_len=None):
-    lengths = np.array([len(x) for x in ragged_array], dtype=np.uint16)
+    lengths = np.fromiter(map(len, ragged_array), dtype=np.uint16, count=len(ragged_array))
     padded = np.zeros((len(ragged_array), max_len or np.max(lengths)), dtype=ragged_array[0].dtype)
-    for x, y in zip(ragged_array, padded):
-        y[:len(x)] = x
+    # a row major boolean mask selects the same slots the ragged rows fill, in order
+    padded[np.arange(padded.shape[1]) < lengths[:, None]] = np.concatenate(ragged_array)
     return padded, lengths
 
 
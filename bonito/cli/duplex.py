@@ -37,7 +37,7 @@ from bonito.util import load_model, half_supported
 from bonito.crf.basecall import transfer, split_read, stitch
 from bonito.fast5 import get_raw_data_for_read, get_fast5_file
 from bonito.util import unbatchify, batchify, chunk, concat, accuracy
-from bonito.multiprocessing import thread_map, process_map, process_cancel
+from bonito.multiprocessing import thread_iter, thread_map, process_map, process_cancel
 
 
 def poagen(groups, gpu_percent=0.8):
@@ -140,43 +140,41 @@ def build_envelope(len1, seq1, path1, len2, seq2, path2, padding=15):
     # needleman-wunsch alignment with constant gap penalty.
     aln = parasail.nw_trace_striped_32(seq2, seq1, 2, 2, parasail.dnafull)
 
+    gap = ord('-')
+
     # pair up positions
     alignment = np.column_stack([
-        np.cumsum([x != '-' for x in aln.traceback.ref]) - 1,
-        np.cumsum([x != '-' for x in aln.traceback.query]) - 1
+        np.cumsum(np.frombuffer(aln.traceback.ref.encode(), dtype=np.uint8) != gap) - 1,
+        np.cumsum(np.frombuffer(aln.traceback.query.encode(), dtype=np.uint8) != gap) - 1
     ])
 
     path_range1 = np.column_stack([path1, path1[1:] + [len1]])
     path_range2 = np.column_stack([path2, path2[1:] + [len2]])
 
-    envelope = np.full((len1, 2), -1, dtype=int)
-
-    for idx1, idx2 in alignment.clip(0):
+    alignment = alignment.clip(0)
+    st_1, en_1 = path_range1[alignment[:, 0]].T
+    st_2, en_2 = path_range2[alignment[:, 1]].T
 
-        st_1, en_1 = path_range1[idx1]
-        st_2, en_2 = path_range2[idx2]
+    # expand every aligned pair to the positions [st_1, en_1) it covers in one ragged scatter
+    counts = en_1 - st_1
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    idx = np.repeat(st_1, counts) + np.arange(counts.sum()) - offsets
 
-        for idx in range(st_1, en_1):
-            if st_2 < envelope[idx, 0] or envelope[idx, 0] < 0:
-                envelope[idx, 0] = st_2
-            if en_2 > envelope[idx, 1] or envelope[idx, 1] < 0:
-                envelope[idx, 1] = en_2
+    unset = np.iinfo(int).max
+    envelope = np.column_stack([np.full(len1, unset, dtype=int), np.full(len1, -1, dtype=int)])
+    np.minimum.at(envelope[:, 0], idx, np.repeat(st_2, counts))
+    np.maximum.at(envelope[:, 1], idx, np.repeat(en_2, counts))
+    envelope[envelope[:, 0] == unset, 0] = -1
 
     # add a little padding to ensure some overlap
     envelope[:, 0] = envelope[:, 0] - padding
     envelope[:, 1] = envelope[:, 1] + padding
     envelope = np.clip(envelope, 0, len2)
 
-    prev_end = 0
-    for i in range(envelope.shape[0]):
-
-        if envelope[i, 0] > envelope[i, 1]:
-            envelope[i, 0] = 0
-
-        if envelope[i, 0] > prev_end:
-            envelope[i, 0] = prev_end
-
-        prev_end = envelope[i, 1]
+    # starts must not pass their own end or the previous end
+    start, end = envelope[:, 0], envelope[:, 1]
+    start[start > end] = 0
+    np.minimum(start, np.concatenate([[0], end[:-1]]), out=start)
 
     return envelope.astype(np.uint64)
 
@@ -215,7 +213,7 @@ def find_follow_on(df, gap=5, distance=51, cov=0.85, min_len=100):
 
 
 def compute_scores(model, batch, reverse=False):
-    with torch.no_grad():
+    with torch.inference_mode():
         device = next(model.parameters()).device
         dtype = torch.float16 if half_supported() else torch.float32
         scores = model.encoder(batch.to(dtype).to(device))
@@ -233,7 +231,7 @@ def basecall(model, reads, chunksize=4000, overlap=500, batchsize=32, reverse=Fa
         read_chunk for read in reads
         for read_chunk in split_read(read, chunksize * batchsize)[::-1 if reverse else 1]
     )
-    chunks = (
+    chunks = thread_iter(
         ((read, start, end),
         chunk(torch.from_numpy(read.signal[start:end]), chunksize, overlap))
         for (read, start, end) in reads
@@ -22,6 +22,44 @@ def stitch_results(results, length, size, overlap, stride, reverse=False):
     return stitch(results, size, overlap, length, stride, reverse=reverse)
 
 
+def split_read(read, split_read_length=400000):
+    """
+    Split large reads into manageable pieces.
+    """
+    if len(read.signal) <= split_read_length:
+        return [(read, 0, len(read.signal))]
+    breaks = np.arange(0, len(read.signal) + split_read_length, split_read_length)
+    return [(read, start, min(end, len(read.signal))) for (start, end) in zip(breaks[:-1], breaks[1:])]
+
+
+def to_device(batch, device, dtype, stream=None):
+    """
+    Host to device transfer using pinned memory on a side stream.
+    """
+    if stream is None:
+        return batch.to(dtype).to(device)
+    with torch.cuda.stream(stream):
+        batch = batch.to(dtype).pin_memory().to(device, non_blocking=True)
+    stream.synchronize()
+    return batch
+
+
+def transfer(x):
+    """
+    Device to host transfer using pinned memory.
+    """
+    stream = torch.cuda.Stream()
+    # wait only for the work already queued on the producing stream, not the whole device
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        x = {
+            k: torch.empty(v.shape, pin_memory=True, dtype=v.dtype).copy_(v, non_blocking=True)
+            for k, v in x.items()
+        }
+    stream.synchronize()
+    return {k: v.numpy() for k, v in x.items()}
+
+
 def compute_scores(model, batch, beam_width=32, beam_cut=100.0, scale=1.0, offset=0.0, blank_score=2.0, reverse=False):
     """
     Compute scores for model.
@@ -29,6 +67,9 @@ def compute_scores(model, batch, beam_width=32, beam_cut=100.0, scale=1.0, offse
     with torch.inference_mode():
         device = next(model.parameters()).device
         dtype = torch.float16 if half_supported() else torch.float32
+        if batch.is_cuda:
+            # batch was copied on a side stream, keep the allocator from reusing it early
+            batch.record_stream(torch.cuda.current_stream(device))
         scores = model(batch.to(dtype).to(device))
         if reverse:
             scores = model.seqdist.reverse_complement(scores)
@@ -44,9 +85,9 @@ def compute_scores(model, batch, beam_width=32, beam_cut=100.0, scale=1.0, offse
 
 
 def apply_stride_to_moves(model, attrs):
-    moves = np.array(attrs['moves'], dtype=bool)
-    sig_move = np.full(moves.size * model.stride, False)
-    sig_move[np.where(moves)[0] * model.stride] = True
+    moves = np.asarray(attrs['moves'], dtype=bool)
+    sig_move = np.zeros(moves.size * model.stride, dtype=bool)
+    sig_move[::model.stride] = moves
     return {
         'qstring': to_str(attrs['qstring']),
         'sequence': to_str(attrs['sequence']),
@@ -63,7 +104,14 @@ def basecall(model, reads, chunksize=4000, overlap=100, batchsize=32, reverse=Fa
         for read in reads
     )
 
-    batches = thread_iter(batchify(chunks, batchsize=batchsize))
+    device = next(model.parameters()).device
+    dtype = torch.float16 if half_supported() else torch.float32
+    stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+
+    batches = thread_iter(
+        (k, to_device(batch, device, dtype, stream))
+        for k, batch in batchify(chunks, batchsize=batchsize)
+    )
 
     scores = thread_iter(
         (read, compute_scores(model, batch, reverse=reverse)) for read, batch in batches
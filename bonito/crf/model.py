@@ -26,6 +26,7 @@ class CTC_CRF(SequenceDist):
     def __init__(self, state_len, alphabet):
         super().__init__()
         self.alphabet = alphabet
+        self.ascii_alphabet = np.frombuffer(''.join(alphabet).encode(), dtype='u1')
         self.state_len = state_len
         self.n_base = len(alphabet[1:])
         self.idx = torch.cat([
@@ -95,8 +96,7 @@ class CTC_CRF(SequenceDist):
         return paths
 
     def path_to_str(self, path):
-        alphabet = np.frombuffer(''.join(self.alphabet).encode(), dtype='u1')
-        seq = alphabet[path[path != 0]]
+        seq = self.ascii_alphabet[path[path != 0]]
         return seq.tobytes().decode()
 
     def prepare_ctc_scores(self, scores, targets):
@@ -6,53 +6,94 @@ import torch
 import numpy as np
 from functools import partial
 
-from bonito.multiprocessing import process_map
+from bonito.multiprocessing import process_map, thread_iter
 from bonito.util import mean_qscore_from_qstring
 from bonito.util import chunk, stitch, batchify, unbatchify, permute
 
 
-def basecall(model, reads, beamsize=5, chunksize=0, overlap=0, batchsize=1, qscores=False, reverse=None):
+def basecall(model, reads, beamsize=5, chunksize=4000, overlap=100, batchsize=32, qscores=False, reverse=None):
     """
     Basecalls a set of reads.
     """
-    chunks = (
-        (read, chunk(torch.tensor(read.signal), chunksize, overlap)) for read in reads
+    chunks = thread_iter(
+        (read, chunk(torch.from_numpy(read.signal), chunksize, overlap)) for read in reads
     )
+    batches = thread_iter(batchify(chunks, batchsize=batchsize))
+    # full batches all share one shape so their forward pass can be replayed from a cuda graph
+    graphs = {} if chunksize else None
     scores = unbatchify(
-        (k, compute_scores(model, v)) for k, v in batchify(chunks, batchsize)
+        (k, compute_scores(model, v, graphs if len(v) == batchsize else None)) for k, v in batches
     )
     scores = (
         (read, {'scores': stitch(v, chunksize, overlap, len(read.signal), model.stride)}) for read, v in scores
     )
-    decoder = partial(decode, decode=model.decode, beamsize=beamsize, qscores=qscores, stride=model.stride)
+    decoder = partial(decode, decode=model.decode_probs, beamsize=beamsize, qscores=qscores, stride=model.stride)
     basecalls = process_map(decoder, scores, n_proc=4)
     return basecalls
 
 
-def compute_scores(model, batch):
+def capture_graph(model, batch, warmup=3):
+    """
+    Capture a cuda graph of the model forward pass for batches shaped like `batch`.
+    """
+    static_input = batch.clone()
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(warmup):
+            model(static_input)
+    torch.cuda.current_stream().wait_stream(stream)
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_output = model(static_input)
+    return graph, static_input, static_output
+
+
+def compute_scores(model, batch, graphs=None):
     """
     Compute scores for model.
     """
     with torch.no_grad():
         device = next(model.parameters()).device
-        chunks = batch.to(torch.half).to(device)
-        probs = permute(model(chunks), 'TNC', 'NTC')
-    return probs.cpu().to(torch.float32)
+        chunks = batch.to(torch.half)
+        if device.type == 'cuda':
+            chunks = chunks.pin_memory()
+        chunks = chunks.to(device, non_blocking=True)
+        if graphs is None or device.type != 'cuda':
+            scores = model(chunks)
+        else:
+            if chunks.shape not in graphs:
+                graphs[chunks.shape] = capture_graph(model, chunks)
+            graph, static_input, scores = graphs[chunks.shape]
+            static_input.copy_(chunks)
+            graph.replay()
+        probs = permute(scores, 'TNC', 'NTC')
+        if device.type != 'cuda':
+            return probs
+        # copy straight into pinned memory rather than through a pageable staging buffer
+        host = torch.empty(probs.shape, dtype=probs.dtype, pin_memory=True)
+        host.copy_(probs, non_blocking=True)
+        torch.cuda.current_stream().synchronize()
+    # scores stay as half precision log probs, `decode` exponentiates them once on the cpu
+    return host
 
 
 def decode(scores, decode, beamsize=5, qscores=False, stride=1):
     """
     Convert the network scores into a sequence.
     """
+    # exponentiate once and share the probs between the greedy and beam search passes
+    probs = np.exp(scores['scores'].numpy(), dtype=np.float32)
+
     # do a greedy decode to get a sensible qstring to compute the mean qscore from
-    seq, path = decode(scores['scores'], beamsize=1, qscores=True, return_path=True)
+    seq, path = decode(probs, beamsize=1, qscores=True, return_path=True)
     seq, qstring = seq[:len(path)], seq[len(path):]
     mean_qscore = mean_qscore_from_qstring(qstring)
 
     # beam search will produce a better sequence but doesn't produce a sensible qstring/path
     if not (qscores or beamsize == 1):
         try:
-            seq = decode(scores['scores'], beamsize=beamsize)
+            seq = decode(probs, beamsize=beamsize)
             path = None
             qstring = '*'
         except:
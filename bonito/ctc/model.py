@@ -37,7 +37,10 @@ class Model(Module):
         return self.decoder(encoded)
 
     def decode(self, x, beamsize=5, threshold=1e-3, qscores=False, return_path=False):
-        x = x.exp().cpu().numpy().astype(np.float32)
+        x = np.exp(x.cpu().numpy(), dtype=np.float32)
+        return self.decode_probs(x, beamsize=beamsize, threshold=threshold, qscores=qscores, return_path=return_path)
+
+    def decode_probs(self, x, beamsize=5, threshold=1e-3, qscores=False, return_path=False):
         if beamsize == 1 or qscores:
             seq, path  = viterbi_search(x, self.alphabet, qscores, self.qscale, self.qbias)
         else:
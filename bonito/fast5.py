@@ -5,10 +5,10 @@ Bonito Fast5 Utils
 import sys
 from glob import glob
 from pathlib import Path
-from itertools import chain
+from itertools import islice
 from functools import partial
 from multiprocessing import Pool
-from collections import OrderedDict
+from collections import deque, OrderedDict
 from datetime import datetime, timedelta
 
 import torch
@@ -143,16 +143,15 @@ def trim(signal, window_size=40, threshold_factor=2.4, min_elements=3):
     threshold = med + mad * threshold_factor
     num_windows = len(signal) // window_size
 
-    seen_peak = False
+    above = signal[:num_windows * window_size].reshape(num_windows, window_size) > threshold
+    peaks = above.sum(axis=1) > min_elements
 
-    for pos in range(num_windows):
-        start = pos * window_size
-        end = start + window_size
-        window = signal[start:end]
-        if len(window[window > threshold]) > min_elements or seen_peak:
-            seen_peak = True
-            if window[-1] > threshold:
-                continue
+    if peaks.any():
+        # trim up to the first window after the first peak that ends below the threshold
+        first_peak = peaks.argmax()
+        below = ~above[first_peak:, -1]
+        if below.any():
+            end = int(first_peak + below.argmax() + 1) * window_size
             return min(end + min_trim, len(signal)), len(signal)
 
     return min_trim, len(signal)
@@ -268,7 +267,7 @@ def get_raw_data(filename, read_ids=None, skip=False):
                 yield Read(f5_fh.get_read(read_id), filename)
 
 
-def get_reads(directory, read_ids=None, skip=False, n_proc=1, recursive=False, cancel=None):
+def get_reads(directory, read_ids=None, skip=False, n_proc=1, recursive=False, cancel=None, prefetch=1):
     """
     Get all reads in a given `directory`.
     """
@@ -276,8 +275,13 @@ def get_reads(directory, read_ids=None, skip=False, n_proc=1, recursive=False, c
     get_filtered_reads = partial(get_read_ids, read_ids=read_ids, skip=skip)
     reads = (Path(x) for x in glob(directory + "/" + pattern, recursive=True))
     with Pool(n_proc) as pool:
-        for job in chain(pool.imap(get_filtered_reads, reads)):
-            for read in pool.imap(get_raw_data_for_read, job):
+        jobs = (pool.imap(get_raw_data_for_read, job) for job in pool.imap(get_filtered_reads, reads))
+        # keep the next `prefetch` files loading while the current file is consumed
+        queued = deque(islice(jobs, prefetch + 1))
+        while queued:
+            job = queued.popleft()
+            queued.extend(islice(jobs, 1))
+            for read in job:
                 yield read
                 if cancel is not None and cancel.is_set():
                     return
@@ -5,8 +5,9 @@ Bonito Input/Output
 import os
 import sys
 import csv
-import pandas as pd
+from queue import Queue
 from threading import Thread
+from functools import lru_cache
 from logging import getLogger
 from collections import namedtuple
 from contextlib import contextmanager
@@ -17,7 +18,7 @@ import numpy as np
 from pysam import AlignmentFile, AlignmentHeader, AlignedSegment
 
 import bonito
-from bonito.cli.convert import typical_indices
+from bonito.cli.convert import typical_indices, pad_lengths
 from bonito.util import mean_qscore_from_qstring
 
 
@@ -26,6 +27,10 @@ Format = namedtuple("Format", "aligned name mode")
 
 __ont_bam_spec__ = "0.0.1"
 
+# ascii -> ctc target lookup table (A, C, G, T -> 1, 2, 3, 4 with 0 as the blank)
+base_lut = np.zeros(256, dtype=np.uint8)
+base_lut[np.frombuffer(b'ACGT', dtype=np.uint8)] = [1, 2, 3, 4]
+
 
 def biofmt(aligned=False):
     """
@@ -55,33 +60,40 @@ def devnull(*args, **kwds):
     A context manager that sends all out stdout & stderr to devnull.
     """
     save_fds = [os.dup(1), os.dup(2)]
-    null_fds = [os.open(os.devnull, os.O_RDWR) for _ in range(2)]
-    os.dup2(null_fds[0], 1)
-    os.dup2(null_fds[1], 2)
+    os.dup2(devnull_fd(), 1)
+    os.dup2(devnull_fd(), 2)
     try:
         yield
     finally:
         os.dup2(save_fds[0], 1)
         os.dup2(save_fds[1], 2)
-        for fd in null_fds + save_fds: os.close(fd)
+        for fd in save_fds: os.close(fd)
+
+
+@lru_cache(maxsize=1)
+def devnull_fd():
+    """
+    A single shared descriptor for devnull, opened on first use.
+    """
+    return os.open(os.devnull, os.O_RDWR | os.O_CLOEXEC)
 
 
-def write_fasta(header, sequence, fd=sys.stdout):
+def write_fasta(header, sequence, fd=None):
     """
-    Write a fasta record to a file descriptor.
+    Write a fasta record to a binary file descriptor.
     """
-    fd.write(f">{header}\n{sequence}\n")
+    if fd is None: fd = sys.stdout.buffer
+    fd.write(b">%s\n%s\n" % (header.encode(), sequence.encode()))
 
 
-def write_fastq(header, sequence, qstring, fd=sys.stdout, tags=None, sep="\t"):
+def write_fastq(header, sequence, qstring, fd=None, tags=None, sep="\t"):
     """
-    Write a fastq record to a file descriptor.
+    Write a fastq record to a binary file descriptor.
     """
+    if fd is None: fd = sys.stdout.buffer
     if tags is not None:
-        fd.write(f"@{header} {sep.join(tags)}\n")
-    else:
-        fd.write(f"@{header}\n")
-    fd.write(f"{sequence}\n+\n{qstring}\n")
+        header = f"{header} {sep.join(tags)}"
+    fd.write(b"@%s\n%s\n+\n%s\n" % (header.encode(), sequence.encode(), qstring.encode()))
 
 
 def sam_header(groups, sep='\t'):
@@ -111,40 +123,44 @@ def sam_header(groups, sep='\t'):
     return '%s\n' % os.linesep.join([HD, PG1, PG2, *groups])
 
 
+@lru_cache(maxsize=None)
+def sam_template(aligned, sep='\t'):
+    """
+    Format template for a string sam record.
+    """
+    if aligned:
+        fields = ['%s', '%s', '%s', '%s', '%s', '%s', '*', '0', '0', '%s', '%s', 'NM:i:%s', 'MD:Z:%s']
+    else:
+        fields = ['%s', '4', '*', '0', '0', '*', '*', '0', '0', '%s', '%s', 'NM:i:0']
+    return sep.join(fields)
+
+
 def sam_record(read_id, sequence, qstring, mapping, tags=None, sep='\t'):
     """
     Format a string sam record.
     """
     if mapping:
-        softclip = [
-            '%sS' % mapping.q_st if mapping.q_st else '',
-            mapping.cigar_str,
-            '%sS' % (len(sequence) - mapping.q_en) if len(sequence) - mapping.q_en else ''
-        ]
-        record = [
-            read_id,
-            0 if mapping.strand == +1 else 16,
-            mapping.ctg,
-            mapping.r_st + 1,
-            mapping.mapq,
-            ''.join(softclip if mapping.strand == +1 else softclip[::-1]),
-            '*', 0, 0,
-            sequence if mapping.strand == +1 else mappy.revcomp(sequence),
-            qstring,
-            'NM:i:%s' % mapping.NM,
-            'MD:Z:%s' % mapping.MD,
-        ]
+        lclip = '%sS' % mapping.q_st if mapping.q_st else ''
+        rclip = '%sS' % (len(sequence) - mapping.q_en) if len(sequence) - mapping.q_en else ''
+        if mapping.strand == +1:
+            flag, cigar = 0, lclip + mapping.cigar_str + rclip
+        else:
+            flag, cigar = 16, rclip + mapping.cigar_str + lclip
+            sequence = mappy.revcomp(sequence)
+        record = sam_template(True, sep) % (
+            read_id, flag, mapping.ctg, mapping.r_st + 1, mapping.mapq, cigar,
+            sequence, qstring, mapping.NM, mapping.MD,
+        )
     else:
-        record = [
-            read_id, 4, '*', 0, 0, '*', '*', 0, 0, sequence, qstring, 'NM:i:0'
-        ]
+        record = sam_template(False, sep) % (read_id, sequence, qstring)
 
-    if tags is not None:
-        record.extend(tags)
+    if tags:
+        record = sep.join([record, *tags])
 
-    return sep.join(map(str, record))
+    return record
 
 
+@lru_cache(maxsize=1)
 def summary_file():
     """
     Return the filename to use for the summary tsv.
@@ -155,6 +171,46 @@ def summary_file():
     return '%s_summary.tsv' % splitext(stdout)[0]
 
 
+def cigar_stats(cigar):
+    """
+    Count the inserted and deleted bases in a mappy cigar.
+    """
+    cigar = np.asarray(cigar, dtype=np.int32).reshape(-1, 2)
+    totals = np.bincount(cigar[:, 1], weights=cigar[:, 0], minlength=3)
+    return int(totals[1]), int(totals[2])
+
+
+def alignment_fields(alignment, seqlen):
+    """
+    Alignment columns of a summary tsv row.
+    """
+    ins, dels = cigar_stats(alignment.cigar)
+    subs = alignment.NM - ins - dels
+    length = alignment.blen
+    matches = length - ins - dels
+    correct = alignment.mlen
+    forward = alignment.strand == +1
+
+    return [
+        alignment.ctg,
+        alignment.r_st,
+        alignment.r_en,
+        alignment.q_st if forward else seqlen - alignment.q_en,
+        alignment.q_en if forward else seqlen - alignment.q_st,
+        '+' if forward else '-',
+        length, matches, correct,
+        ins, dels, subs,
+        alignment.mapq,
+        (alignment.q_en - alignment.q_st) / seqlen,
+        correct / matches,
+        correct / length,
+    ]
+
+
+# alignment columns for reads that failed to map
+unaligned_fields = ['*', -1, -1, -1, -1, '*', 0, 0, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0]
+
+
 summary_field_names = [
     'filename',
     'read_id',
@@ -186,6 +242,12 @@ summary_field_names = [
     'alignment_accuracy',
 ]
 
+# one row type per width, rows without an aligner stop before the alignment columns
+summary_rows = {
+    n: namedtuple('SummaryRow', summary_field_names[:n])
+    for n in (len(summary_field_names) - len(unaligned_fields), len(summary_field_names))
+}
+
 
 def summary_row(read, seqlen, qscore, alignment=False):
     """
@@ -206,35 +268,11 @@ def summary_row(read, seqlen, qscore, alignment=False):
     ]
 
     if alignment:
-
-        ins = sum(count for count, op in alignment.cigar if op == 1)
-        dels = sum(count for count, op in alignment.cigar if op == 2)
-        subs = alignment.NM - ins - dels
-        length = alignment.blen
-        matches = length - ins - dels
-        correct = alignment.mlen
-
-        fields.extend([
-            alignment.ctg,
-            alignment.r_st,
-            alignment.r_en,
-            alignment.q_st if alignment.strand == +1 else seqlen - alignment.q_en,
-            alignment.q_en if alignment.strand == +1 else seqlen - alignment.q_st,
-            '+' if alignment.strand == +1 else '-',
-            length, matches, correct,
-            ins, dels, subs,
-            alignment.mapq,
-            (alignment.q_en - alignment.q_st) / seqlen,
-            correct / matches,
-            correct / length,
-        ])
-
+        fields.extend(alignment_fields(alignment, seqlen))
     elif alignment is None:
-        fields.extend(
-            ['*', -1, -1, -1, -1, '*', 0, 0, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0]
-        )
+        fields.extend(unaligned_fields)
 
-    return dict(zip(summary_field_names, fields))
+    return summary_rows[len(fields)]._make(fields)
 
 
 duplex_summary_field_names = [
@@ -268,6 +306,11 @@ duplex_summary_field_names = [
     'alignment_accuracy',
 ]
 
+duplex_summary_rows = {
+    n: namedtuple('DuplexSummaryRow', duplex_summary_field_names[:n])
+    for n in (len(duplex_summary_field_names) - len(unaligned_fields), len(duplex_summary_field_names))
+}
+
 
 def duplex_summary_row(read_temp, comp_read, seqlen, qscore, alignment=False):
     """
@@ -288,48 +331,27 @@ def duplex_summary_row(read_temp, comp_read, seqlen, qscore, alignment=False):
     ]
 
     if alignment:
-
-        ins = sum(count for count, op in alignment.cigar if op == 1)
-        dels = sum(count for count, op in alignment.cigar if op == 2)
-        subs = alignment.NM - ins - dels
-        length = alignment.blen
-        matches = length - ins - dels
-        correct = alignment.mlen
-
-        fields.extend([
-            alignment.ctg,
-            alignment.r_st,
-            alignment.r_en,
-            alignment.q_st if alignment.strand == +1 else seqlen - alignment.q_en,
-            alignment.q_en if alignment.strand == +1 else seqlen - alignment.q_st,
-            '+' if alignment.strand == +1 else '-',
-            length, matches, correct,
-            ins, dels, subs,
-            alignment.mapq,
-            (alignment.q_en - alignment.q_st) / seqlen,
-            correct / matches,
-            correct / length,
-        ])
-
+        fields.extend(alignment_fields(alignment, seqlen))
     elif alignment is None:
-        fields.extend(
-            ['*', -1, -1, -1, -1, '*', 0, 0, 0, 0, 0, 0, 0, 0.0, 0.0, 0.0]
-        )
+        fields.extend(unaligned_fields)
 
-    return dict(zip(duplex_summary_field_names, fields))
+    return duplex_summary_rows[len(fields)]._make(fields)
 
 
 class CSVLogger:
-    def __init__(self, filename, sep=','):
+    def __init__(self, filename, sep=',', batchsize=1):
         self.filename = str(filename)
         if os.path.exists(self.filename):
             with open(self.filename) as f:
                 self.columns = csv.DictReader(f).fieldnames
         else:
             self.columns = None
-        self.fh = open(self.filename, 'a', newline='')
+        # only batched loggers get a large buffer, the default keeps rows visible as they are logged
+        self.fh = open(self.filename, 'a', newline='', buffering=1 << 20 if batchsize > 1 else -1)
+        self.batchsize = batchsize
         self.csvwriter = csv.writer(self.fh, delimiter=sep)
-        self.count = 0
+        self.fields = None
+        self.rows = []
 
     def set_columns(self, columns):
         if self.columns:
@@ -337,16 +359,30 @@ class CSVLogger:
         self.columns = list(columns)
         self.csvwriter.writerow(self.columns)
 
+    def in_order(self, fields):
+        # namedtuple rows share one _fields tuple so the check against the columns is done once
+        if fields is not self.fields and list(fields) == self.columns:
+            self.fields = fields
+        return fields is self.fields
+
     def append(self, row):
+        fields = getattr(row, '_fields', None)
         if self.columns is None:
-            self.set_columns(row.keys())
-        self.csvwriter.writerow([row.get(k, '-') for k in self.columns])
-        self.count += 1
-        if self.count > 100:
-            self.count = 0
-            self.fh.flush()
+            self.set_columns(row.keys() if fields is None else fields)
+        if fields is not None and self.in_order(fields):
+            self.rows.append(row)
+        else:
+            if fields is not None: row = row._asdict()
+            self.rows.append([row.get(k, '-') for k in self.columns])
+        if len(self.rows) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        self.csvwriter.writerows(self.rows)
+        self.rows.clear()
 
     def close(self):
+        self.flush()
         self.fh.close()
 
     def __enter__(self):
@@ -388,6 +424,7 @@ class Writer(Thread):
         self.iterator = iterator
         self.fastq = mode == 'wfq'
         self.group_key = group_key
+        self.error = None
         self.output = AlignmentFile(
             fd, 'w' if self.fastq else self.mode, add_sam_header=not self.fastq,
             reference_filename=ref_fn,
@@ -401,48 +438,79 @@ class Writer(Thread):
         )
 
     def run(self):
-        with CSVLogger(summary_file(), sep='\t') as summary:
-            for read, res in self.iterator:
-
-                seq = res['sequence']
-                qstring = res.get('qstring', '*')
-                mean_qscore = res.get('mean_qscore', mean_qscore_from_qstring(qstring))
-                mapping = res.get('mapping', False)
-                mods_tags = res.get('mods', [])
-
-                if self.duplex:
-                    samples = len(read[0].signal) + len(read[1].signal)
-                    read_id = '%s;%s' % (read[0].read_id, read[1].read_id)
-                else:
-                    samples = len(read.signal)
-                    read_id = read.read_id
-
-                tags = [
-                    f'RG:Z:{read.run_id}_{self.group_key}',
-                    f'qs:i:{round(mean_qscore)}',
-                    *read.tagdata(),
-                    *mods_tags,
-                ]
-
-                if len(seq):
-                    if self.mode == 'wfq':
-                        write_fastq(read_id, seq, qstring, fd=self.fd, tags=tags)
+        # collect records in a large buffer and write them out in big blocks, not per read
+        self.fd.flush()
+        records = open(self.fd.fileno(), 'wb', buffering=1 << 20, closefd=False)
+        with records, CSVLogger(summary_file(), sep='\t', batchsize=1024) as summary:
+            # format records here and leave the blocking writes to a second thread
+            queue = Queue(maxsize=64)
+            io = Thread(target=self.write, args=(queue, records, summary))
+            io.start()
+            try:
+                for read, res in self.iterator:
+
+                    if self.error is not None:
+                        break
+
+                    seq = res['sequence']
+                    qstring = res.get('qstring', '*')
+                    mean_qscore = res.get('mean_qscore', mean_qscore_from_qstring(qstring))
+                    mapping = res.get('mapping', False)
+                    mods_tags = res.get('mods', [])
+
+                    if self.duplex:
+                        samples = len(read[0].signal) + len(read[1].signal)
+                        read_id = '%s;%s' % (read[0].read_id, read[1].read_id)
                     else:
-                        self.output.write(
-                            AlignedSegment.fromstring(
+                        samples = len(read.signal)
+                        read_id = read.read_id
+
+                    tags = [
+                        f'RG:Z:{read.run_id}_{self.group_key}',
+                        f'qs:i:{round(mean_qscore)}',
+                        *read.tagdata(),
+                        *mods_tags,
+                    ]
+
+                    if len(seq):
+                        if self.mode == 'wfq':
+                            record = (read_id, seq, qstring, tags)
+                        else:
+                            record = AlignedSegment.fromstring(
                                 sam_record(read_id, seq, qstring, mapping, tags=tags),
                                 self.output.header
                             )
-                        )
-                    if self.duplex:
-                        summary.append(duplex_summary_row(read[0], read[1], len(seq), mean_qscore, alignment=mapping))
-                    else:
-                        summary.append(summary_row(read, len(seq), mean_qscore, alignment=mapping))
+                        if self.duplex:
+                            row = duplex_summary_row(read[0], read[1], len(seq), mean_qscore, alignment=mapping)
+                        else:
+                            row = summary_row(read, len(seq), mean_qscore, alignment=mapping)
 
-                    self.log.append((read_id, samples))
+                        queue.put((record, row, (read_id, samples)))
 
+                    else:
+                        logger.warn("> skipping empty sequence %s", read_id)
+            finally:
+                queue.put(None)
+                io.join()
+
+        if self.error is not None:
+            raise self.error
+
+    def write(self, queue, records, summary):
+        items = iter(queue.get, None)
+        try:
+            for record, row, log in items:
+                if self.mode == 'wfq':
+                    read_id, seq, qstring, tags = record
+                    write_fastq(read_id, seq, qstring, fd=records, tags=tags)
                 else:
-                    logger.warn("> skipping empty sequence %s", read_id)
+                    self.output.write(record)
+                summary.append(row)
+                self.log.append(log)
+        except Exception as e:
+            self.error = e
+            # keep draining until run() stops so it never blocks on a full queue
+            for _ in items: pass
 
 
 class CTCWriter(Thread):
@@ -474,70 +542,73 @@ class CTCWriter(Thread):
 
     def run(self):
 
+        rows = []
         chunks = []
         targets = []
-        lengths = []
 
-        with CSVLogger(summary_file(), sep='\t') as summary:
-            for read, ctc_data in self.iterator:
+        for read, ctc_data in self.iterator:
 
-                seq = ctc_data['sequence']
-                qstring = ctc_data['qstring']
-                mean_qscore = ctc_data.get('mean_qscore', mean_qscore_from_qstring(qstring))
-                mapping = ctc_data.get('mapping', False)
+            seq = ctc_data['sequence']
+            qstring = ctc_data['qstring']
+            mean_qscore = ctc_data.get('mean_qscore', mean_qscore_from_qstring(qstring))
+            mapping = ctc_data.get('mapping', False)
 
-                self.log.append((read.read_id, len(read.signal)))
+            self.log.append((read.read_id, len(read.signal)))
 
-                if len(seq) == 0 or mapping is None:
-                    continue
+            if len(seq) == 0 or mapping is None:
+                continue
 
-                cov = (mapping.q_en - mapping.q_st) / len(seq)
-                acc = mapping.mlen / mapping.blen
-                refseq = self.aligner.seq(mapping.ctg, mapping.r_st, mapping.r_en)
+            cov = (mapping.q_en - mapping.q_st) / len(seq)
+            acc = mapping.mlen / mapping.blen
+            refseq = self.aligner.seq(mapping.ctg, mapping.r_st, mapping.r_en)
 
-                if acc < self.min_accuracy or cov < self.min_coverage or 'N' in refseq:
-                    continue
+            if acc < self.min_accuracy or cov < self.min_coverage or 'N' in refseq:
+                continue
 
-                self.output.write(
-                    AlignedSegment.fromstring(
-                        sam_record(read.read_id, seq, qstring, mapping),
-                        self.output.header
-                    )
+            self.output.write(
+                AlignedSegment.fromstring(
+                    sam_record(read.read_id, seq, qstring, mapping),
+                    self.output.header
                 )
-                summary.append(summary_row(read, len(seq), mean_qscore, alignment=mapping))
+            )
+            rows.append(summary_row(read, len(seq), mean_qscore, alignment=mapping))
 
-                if mapping.strand == -1:
-                    refseq = mappy.revcomp(refseq)
+            if mapping.strand == -1:
+                refseq = mappy.revcomp(refseq)
 
-                target = [int(x) for x in refseq.translate({65: '1', 67: '2', 71: '3', 84: '4'})]
-                targets.append(target)
-                chunks.append(read.signal)
-                lengths.append(len(target))
+            target = base_lut[np.frombuffer(refseq.encode(), dtype=np.uint8)]
+            targets.append(target)
+            chunks.append(read.signal.astype(np.float16))
 
         if len(chunks) == 0:
             sys.stderr.write("> no suitable ctc data to write\n")
             return
 
-        chunks = np.array(chunks, dtype=np.float16)
-        targets_ = np.zeros((chunks.shape[0], max(lengths)), dtype=np.uint8)
-        for idx, target in enumerate(targets): targets_[idx, :len(target)] = target
-        lengths = np.array(lengths, dtype=np.uint16)
+        targets_, lengths = pad_lengths(targets)
         indices = np.random.permutation(typical_indices(lengths))
 
-        chunks = chunks[indices]
         targets_ = targets_[indices]
         lengths = lengths[indices]
 
-        summary = pd.read_csv(summary_file(), sep='\t')
-        summary.iloc[indices].to_csv(summary_file(), sep='\t', index=False)
+        # the summary rows are kept in memory and written once in the shuffled order
+        with CSVLogger(summary_file(), sep='\t', batchsize=1024) as summary:
+            for i in indices: summary.append(rows[i])
 
         output_directory = '.' if sys.stdout.isatty() else dirname(realpath('/dev/fd/1'))
-        np.save(os.path.join(output_directory, "chunks.npy"), chunks)
+
+        # copy the shuffled chunks straight into the npy file rather than building a second array in memory
+        chunks_ = np.lib.format.open_memmap(
+            os.path.join(output_directory, "chunks.npy"), mode='w+',
+            dtype=np.float16, shape=(len(indices), len(chunks[0]))
+        )
+        for j, i in enumerate(indices): chunks_[j] = chunks[i]
+        chunks_.flush()
+
         np.save(os.path.join(output_directory, "references.npy"), targets_)
         np.save(os.path.join(output_directory, "reference_lengths.npy"), lengths)
 
         sys.stderr.write("> written ctc training data\n")
-        sys.stderr.write("  - chunks.npy with shape (%s)\n" % ','.join(map(str, chunks.shape)))
+        sys.stderr.write("  - chunks.npy with shape (%s)\n" % ','.join(map(str, chunks_.shape)))
         sys.stderr.write("  - references.npy with shape (%s)\n" % ','.join(map(str, targets_.shape)))
         sys.stderr.write("  - reference_lengths.npy shape (%s)\n" % ','.join(map(str, lengths.shape)))
 
@@ -112,7 +112,8 @@ class LinearCRFEncoder(Module):
         if self.activation is not None:
             scores = self.activation(scores)
         if self.scale is not None:
-            scores = scores * self.scale
+            # scale in place when there is no graph to keep the activation output for
+            scores = scores * self.scale if torch.is_grad_enabled() else scores.mul_(self.scale)
         if self.blank_score is not None and self.expand_blanks:
             T, N, C = scores.shape
             scores = torch.nn.functional.pad(
@@ -135,7 +135,9 @@ def decode_ref(encoded, labels):
     """
     Convert a integer encoded reference into a string and remove blanks
     """
-    return ''.join(labels[e] for e in encoded if e)
+    alphabet = np.frombuffer(''.join(labels).encode(), dtype=np.uint8)
+    encoded = np.asarray(encoded)
+    return alphabet[encoded[encoded != 0]].tobytes().decode()
 
 
 def column_to_set(filename, idx=0, skip_header=False):